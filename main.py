@@ -1,13 +1,62 @@
-from fastapi import FastAPI, Query
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from cachetools import LRUCache, TTLCache
+from fastapi import FastAPI, Query, Request
+from fastapi.responses import ORJSONResponse, Response
+from redis.exceptions import RedisError
 import httpx
+import orjson
+import redis.asyncio as aioredis
 import asyncio
+import hashlib
+import logging
+import os
+import random
 import time
 import re
+import string
 import unicodedata
 
-app = FastAPI(title="API INE Municipios", version="3.1")
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Crea un único cliente HTTP compartido (keep-alive + HTTP/2) y, si hay REDIS_URL,
+    el cliente de Redis para compartir la caché entre workers. Los cierra al apagar.
+    """
+    redis_url = os.getenv("REDIS_URL")
+    app.state.redis = aioredis.from_url(redis_url) if redis_url else None
+    app.state.client = httpx.AsyncClient(
+        timeout=15,
+        follow_redirects=True,
+        http2=True,  # multiplexa todas las peticiones a servicios.ine.es en una conexión
+        headers={"Accept-Encoding": "gzip, br"},  # br requiere el paquete brotli
+        limits=httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=20,
+            keepalive_expiry=30,
+        ),
+    )
+    try:
+        yield
+    finally:
+        await app.state.client.aclose()
+        if app.state.redis is not None:
+            await app.state.redis.aclose()
+
+
+app = FastAPI(
+    title="API INE Municipios",
+    version="3.1",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 # --- CONFIGURACIÓN ---
+SERIES_TABLA_URL = "https://servicios.ine.es/wstempus/jsCache/ES/SERIES_TABLA/{tabla_id}"
+DATOS_SERIE_URL = "https://servicios.ine.es/wstempus/jsCache/ES/DATOS_SERIE/{codigo}"
+
 TABLAS_MUNICIPALES = {
     "poblacion_municipio": "29005",
     "viviendas_por_municipio": "3456",
@@ -22,11 +71,33 @@ FILTRO_EXCLUIR = [
     "ocupados", "consumo", "Censo", "censo", "vacías",
     "convencionales", "Mediana", "cuartil"
 ]
+EXCLUDE_RE = re.compile("|".join(re.escape(p.lower()) for p in FILTRO_EXCLUIR))
+
+MAX_PETICIONES_INE = 8  # peticiones simultáneas al INE (ajustar si aparecen 429)
+SEM_INE = asyncio.Semaphore(MAX_PETICIONES_INE)
+
+MAX_INTENTOS = 4
+MAX_ESPERA_REINTENTO = 8  # segundos; con un Retry-After mayor no se reintenta
+ESTADOS_REINTENTABLES = {429, 500, 502, 503, 504}
 
 CACHE_TTL = 3600  # 1 hora
-cache = {}  # memoria local: {municipio: (timestamp, data)}
+CACHE_MAXSIZE = 1024
+cache = TTLCache(maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL)  # LRU + TTL: {clave: data}
+cache_lock = asyncio.Lock()
+# Consultas en curso por clave (single-flight): {clave: asyncio.Task}
+inflight: dict[str, asyncio.Task] = {}
+# Último resultado válido por clave, sin caducidad: respaldo si el INE no responde
+ultimo_valido = LRUCache(maxsize=CACHE_MAXSIZE)  # {clave: (timestamp, data)}
+
+# ETag devuelto por el INE por URL, para revalidar con If-None-Match
+etags_ine = LRUCache(maxsize=4096)  # {(url, params): (etag, data)}
+
+# Caché HTTP de respuestas crudas del INE por (url, params) (compartida entre municipios)
+cache_series_tabla = TTLCache(maxsize=64, ttl=24 * 3600)  # SERIES_TABLA: 24 h
+cache_datos_serie = TTLCache(maxsize=4096, ttl=3600)  # DATOS_SERIE: 1 h
 
 # --- NORMALIZACIÓN Y FILTRO PRECISO ---
+@lru_cache(maxsize=65536)
 def normalizar(texto: str) -> str:
     """Convierte texto a minúsculas, sin acentos ni tildes."""
     if not texto:
@@ -37,101 +108,309 @@ def normalizar(texto: str) -> str:
         if unicodedata.category(c) != "Mn"
     )
 
-def coincide_municipio(nombre_serie: str, municipio: str) -> bool:
+_PERMITIDOS = frozenset(string.ascii_lowercase + string.digits + "áéíóúüñ-")
+
+class _TablaPuntuacion(dict):
     """
-    Coincidencia estricta: el nombre de la serie debe comenzar con el municipio exacto.
-    Evita falsos positivos como 'Humanes de Madrid' al buscar 'Madrid'.
+    Tabla para str.translate equivalente a re.sub(r"[^a-z0-9áéíóúüñ\\s-]", " ", ...):
+    conserva la lista de permitidos y los espacios, y cambia el resto por espacio.
+    Cada carácter se resuelve una vez y queda memorizado.
     """
-    nombre = normalizar(nombre_serie)
-    muni = normalizar(municipio)
+    def __missing__(self, cp: int):
+        ch = chr(cp)
+        valor = cp if ch in _PERMITIDOS or ch.isspace() else " "
+        self[cp] = valor
+        return valor
 
-    # Limpiamos puntuación inicial o final
-    nombre = re.sub(r"[^a-z0-9áéíóúüñ\s-]", " ", nombre)
-    muni = re.sub(r"[^a-z0-9áéíóúüñ\s-]", " ", muni)
+_PUNCT_TABLE = _TablaPuntuacion()
 
+def normalizar_nombre(texto: str) -> str:
+    """Normaliza y limpia puntuación y espacios repetidos, para comparar nombres."""
+    # Limpiamos puntuación inicial o final
+    texto = normalizar(texto).translate(_PUNCT_TABLE)
     # Reemplazamos múltiples espacios
-    nombre = re.sub(r"\s+", " ", nombre).strip()
-    muni = re.sub(r"\s+", " ", muni).strip()
+    return " ".join(texto.split())
 
+def coincide_municipio_pre(nombre_serie: str, muni_norm: str) -> bool:
+    """Como `coincide_municipio`, con el municipio ya pasado por `normalizar_nombre`."""
+    nombre = normalizar_nombre(nombre_serie)
     # Comprobamos si el nombre comienza con el municipio buscado
-    return nombre.startswith(muni + " ") or nombre == muni
+    return nombre.startswith(muni_norm + " ") or nombre == muni_norm
+
+def coincide_municipio(nombre_serie: str, municipio: str) -> bool:
+    """
+    Coincidencia estricta: el nombre de la serie debe comenzar con el municipio exacto.
+    Evita falsos positivos como 'Humanes de Madrid' al buscar 'Madrid'.
+    """
+    return coincide_municipio_pre(nombre_serie, normalizar_nombre(municipio))
 
 
 # --- FUNCIONES ASÍNCRONAS ---
-async def get_json_async(url: str, timeout: int = 15):
-    """Devuelve JSON desde una URL, siguiendo redirecciones."""
-    async with httpx.AsyncClient(timeout=timeout, follow_redirects=True) as client:
-        resp = await client.get(url)
+def _espera_reintento(intento: int, resp: httpx.Response | None = None) -> float | None:
+    """
+    Segundos a esperar antes del siguiente intento (Retry-After o backoff con jitter).
+    None si el INE pide esperar más de MAX_ESPERA_REINTENTO: no se reintenta.
+    """
+    if resp is not None:
+        retry_after = resp.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            espera = float(retry_after)
+            return espera if espera <= MAX_ESPERA_REINTENTO else None
+    return min(2 ** intento, MAX_ESPERA_REINTENTO) * random.uniform(0.5, 1.5)
+
+async def get_json_async(
+    client: httpx.AsyncClient,
+    url: str,
+    cache_http: TTLCache | None = None,
+    params: dict | None = None,
+    transformar=None,
+):
+    """Devuelve JSON desde una URL usando el cliente compartido, con reintentos.
+
+    Si se indica `cache_http`, la respuesta se guarda por (url, params) y se reutiliza
+    mientras no caduque. `transformar` se aplica al JSON recién decodificado, antes de
+    cachearlo, para no retener en memoria la respuesta completa.
+    """
+    clave = (url, tuple(sorted(params.items()))) if params else (url, ())
+    if cache_http is not None and clave in cache_http:
+        return cache_http[clave]
+    previo = etags_ine.get(clave)
+    headers = {"If-None-Match": previo[0]} if previo else None
+    for intento in range(MAX_INTENTOS):
+        ultimo = intento == MAX_INTENTOS - 1
+        try:
+            async with SEM_INE:
+                resp = await client.get(url, params=params, headers=headers)
+        except httpx.TransportError:
+            if ultimo:
+                raise
+            await asyncio.sleep(_espera_reintento(intento))
+            continue
+        logger.debug(
+            "GET %s -> %s %s (%s)", resp.url, resp.http_version, resp.status_code,
+            resp.headers.get("content-encoding", "identity"),
+        )
+        if resp.status_code in ESTADOS_REINTENTABLES and not ultimo:
+            espera = _espera_reintento(intento, resp)
+            if espera is None:
+                break  # raise_for_status() lo propaga; sirve el fallback stale
+            await asyncio.sleep(espera)
+            continue
+        break
+    # httpx trata el 304 como redirección y raise_for_status() lo rechazaría
+    if resp.status_code == 304 and previo:
+        data = previo[1]
+    else:
         resp.raise_for_status()
-        data = resp.json()
-        return data if isinstance(data, (list, dict)) else []
+        data = orjson.loads(resp.content)
+        data = data if isinstance(data, (list, dict)) else []
+        if transformar is not None:
+            data = transformar(data)
+        etag = resp.headers.get("ETag")
+        if etag:
+            etags_ine[clave] = (etag, data)
+    if cache_http is not None:
+        cache_http[clave] = data
+    return data
 
-async def get_series_municipio(tabla_id: str, municipio: str):
-    """Obtiene todas las series de un municipio dentro de una tabla."""
-    url = f"https://servicios.ine.es/wstempus/jsCache/ES/SERIES_TABLA/{tabla_id}"
-    data = await get_json_async(url)
+def compactar_series(data) -> list:
+    """
+    Reduce la respuesta de SERIES_TABLA a {COD, Nombre} de las series no excluidas.
+    Se aplica una vez por descarga, así la caché no guarda la tabla completa.
+    """
     if not isinstance(data, list):
         return []
-    return [s for s in data if coincide_municipio(s.get("Nombre", ""), municipio)]
-
-def filtrar_series(series, excluir=None):
-    """Excluye series por palabras clave negativas."""
-    if not excluir:
-        return series
-    return [
-        s for s in series
-        if not any(p.lower() in s.get("Nombre", "").lower() for p in excluir)
-    ]
-
-async def get_datos_serie(codigo: str, n_last: int = 3):
+    series = []
+    for s in data:
+        if not isinstance(s, dict):
+            continue
+        nombre = s.get("Nombre") or ""
+        if EXCLUDE_RE.search(nombre.lower()):
+            continue
+        series.append({"COD": s.get("COD"), "Nombre": nombre})
+    return series
+
+async def get_series_municipio(client: httpx.AsyncClient, tabla_id: str, muni_norm: str):
+    """Obtiene las series de un municipio (ya normalizado) dentro de una tabla, sin las excluidas."""
+    url = SERIES_TABLA_URL.format(tabla_id=tabla_id)
+    series = await get_json_async(client, url, cache_series_tabla, transformar=compactar_series)
+    return [s for s in series if coincide_municipio_pre(s["Nombre"], muni_norm)]
+
+async def get_datos_serie(client: httpx.AsyncClient, codigo: str, n_last: int = 3):
     """Obtiene los últimos valores de una serie concreta."""
-    url = f"https://servicios.ine.es/wstempus/jsCache/ES/DATOS_SERIE/{codigo}?nult={n_last}"
-    data = await get_json_async(url)
+    url = DATOS_SERIE_URL.format(codigo=codigo)
+    data = await get_json_async(client, url, cache_datos_serie, params={"nult": n_last})
     return data if data else []
 
-async def get_datos_municipio(municipio: str, n_last: int = 3):
-    """Consulta en paralelo todas las tablas del INE para un municipio."""
-    # --- Comprobar caché ---
-    now = time.time()
-    if municipio in cache:
-        timestamp, data = cache[municipio]
-        if now - timestamp < CACHE_TTL:
-            return data  # devolver desde caché
+def clave_cache(municipio: str, n_last: int) -> str:
+    """Clave de caché por (municipio normalizado, n_last)."""
+    return hashlib.blake2b(f"{normalizar(municipio)}|{n_last}".encode()).hexdigest()
 
+async def consultar_ine(client: httpx.AsyncClient, municipio: str, n_last: int = 3):
+    """Consulta en paralelo todas las tablas del INE para un municipio."""
     resultados = {}
     tareas = []
+    muni_norm = normalizar_nombre(municipio)  # una sola vez por consulta
 
-    for nombre_indicador, tabla_id in TABLAS_MUNICIPALES.items():
-        tareas.append(asyncio.create_task(get_series_municipio(tabla_id, municipio)))
+    for tabla_id in TABLAS_MUNICIPALES.values():
+        tareas.append(asyncio.create_task(get_series_municipio(client, tabla_id, muni_norm)))
 
     todas_series = await asyncio.gather(*tareas, return_exceptions=True)
 
-    for idx, series in enumerate(todas_series):
-        nombre_indicador = list(TABLAS_MUNICIPALES.keys())[idx]
+    pendientes = []  # (indicador, nombre de serie) en el mismo orden que tareas_datos
+    tareas_datos = []
+
+    for nombre_indicador, series in zip(TABLAS_MUNICIPALES, todas_series):
         if isinstance(series, Exception):
             resultados[nombre_indicador] = {"error": str(series)}
             continue
 
-        series_filtradas = filtrar_series(series, FILTRO_EXCLUIR)
-        datos_tabla = {}
+        resultados[nombre_indicador] = {}
 
-        for s in series_filtradas[:3]:  # límite 3 por tabla (para no exceder timeout)
+        for s in series[:3]:  # límite 3 por tabla (para no exceder timeout)
             cod = s.get("COD")
             nombre = s.get("Nombre")
             if not cod or not nombre:
                 continue
-            try:
-                datos = await get_datos_serie(cod, n_last=n_last)
-                datos_tabla[nombre] = datos
-            except Exception as e:
-                datos_tabla[nombre] = {"error": str(e)}
+            pendientes.append((nombre_indicador, nombre))
+            tareas_datos.append(get_datos_serie(client, cod, n_last=n_last))
 
-        resultados[nombre_indicador] = datos_tabla
+    # Descarga de todas las series (todas las tablas) en un único gather
+    todos_datos = await asyncio.gather(*tareas_datos, return_exceptions=True)
+
+    for (nombre_indicador, nombre), datos in zip(pendientes, todos_datos):
+        if isinstance(datos, Exception):
+            datos = {"error": str(datos)}
+        resultados[nombre_indicador][nombre] = datos
 
-    # Guardar en caché
-    cache[municipio] = (now, resultados)
     return resultados
 
+def tabla_con_errores(tabla: dict) -> bool:
+    """True si la tabla o alguna de sus series devolvió {"error": ...} en lugar de datos."""
+    # tabla fallida: {"error": "..."}; serie fallida: {nombre: {"error": "..."}}
+    return any(
+        isinstance(v, str) or (isinstance(v, dict) and "error" in v)
+        for v in tabla.values()
+    )
+
+def tablas_validas(resultados: dict) -> dict:
+    """Subconjunto de `resultados` con las tablas que se consultaron sin errores."""
+    return {k: v for k, v in resultados.items() if not tabla_con_errores(v)}
+
+async def leer_redis(redis: aioredis.Redis | None, clave: str):
+    """
+    Lee (timestamp, data) de la caché compartida; None si no hay Redis, no existe,
+    falla o el valor guardado no es válido.
+    """
+    if redis is None:
+        return None
+    try:
+        raw = await redis.get(clave)
+    except RedisError as e:
+        logger.warning("Redis no disponible al leer %s: %s", clave, e)
+        return None
+    if not raw:
+        return None
+    try:
+        valor = orjson.loads(raw)
+        return float(valor["ts"]), valor["datos"]
+    except (orjson.JSONDecodeError, TypeError, KeyError, ValueError) as e:
+        logger.warning("Valor inválido en Redis para %s: %s", clave, e)
+        return None
+
+async def guardar_redis(redis: aioredis.Redis | None, clave: str, timestamp: float, data) -> None:
+    """Guarda un resultado en la caché compartida con el mismo TTL que la local."""
+    if redis is None:
+        return
+    try:
+        await redis.setex(clave, CACHE_TTL, orjson.dumps({"ts": timestamp, "datos": data}))
+    except RedisError as e:
+        logger.warning("Redis no disponible al guardar %s: %s", clave, e)
+
+async def get_datos_municipio(
+    client: httpx.AsyncClient,
+    municipio: str,
+    n_last: int = 3,
+    redis: aioredis.Redis | None = None,
+):
+    """
+    Devuelve (datos, stale_since) para un municipio, usando la caché si es posible.
+    Si el INE falla y existe un resultado anterior, se devuelve ese con su timestamp
+    en `stale_since`; en caso normal `stale_since` es None.
+    """
+    # --- Comprobar caché ---
+    clave = clave_cache(municipio, n_last)
+    async with cache_lock:
+        data = cache.get(clave)
+    if data is not None:
+        return data, None  # devolver desde caché
+
+    # Peticiones simultáneas para la misma clave comparten una única consulta al INE
+    tarea = inflight.get(clave)
+    if tarea is None:
+        tarea = asyncio.create_task(resolver_municipio(client, clave, municipio, n_last, redis))
+        inflight[clave] = tarea
+        tarea.add_done_callback(lambda _: inflight.pop(clave, None))
+    return await asyncio.shield(tarea)
+
+async def resolver_municipio(
+    client: httpx.AsyncClient,
+    clave: str,
+    municipio: str,
+    n_last: int,
+    redis: aioredis.Redis | None = None,
+):
+    """
+    Busca en la caché compartida (Redis) y, si no está, consulta el INE y actualiza
+    ambas cachés; recurre al último resultado válido si el INE falla.
+    """
+    en_redis = await leer_redis(redis, clave)
+    if en_redis is not None:
+        timestamp, data = en_redis
+        validas = tablas_validas(data)
+        async with cache_lock:
+            cache[clave] = data
+            if validas:
+                ultimo_valido[clave] = (timestamp, validas)
+        return data, None
+
+    try:
+        resultados = await consultar_ine(client, municipio, n_last=n_last)
+    except Exception:
+        if clave not in ultimo_valido:
+            raise
+        timestamp, data = ultimo_valido[clave]
+        return data, timestamp
+
+    # Si no se pudo consultar ninguna tabla, mejor el último válido si existe
+    validas = tablas_validas(resultados)
+    if not validas:
+        if clave in ultimo_valido:
+            timestamp, data = ultimo_valido[clave]
+            return data, timestamp
+        return resultados, None
+
+    # Guardar en caché (un fallo parcial se cachea igual; el respaldo solo guarda lo válido)
+    timestamp = time.time()
+    async with cache_lock:
+        cache[clave] = resultados
+        ultimo_valido[clave] = (timestamp, validas)
+    await guardar_redis(redis, clave, timestamp, resultados)
+    return resultados, None
+
+def respuesta_cacheable(request: Request, contenido: dict, max_age: int) -> Response:
+    """Serializa con ETag y Cache-Control; responde 304 si el cliente ya tiene esa versión."""
+    cuerpo = orjson.dumps(contenido)
+    etag = f'"{hashlib.blake2b(cuerpo).hexdigest()[:16]}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={max_age}" if max_age else "no-cache",
+    }
+    etiquetas = {t.strip().removeprefix("W/") for t in request.headers.get("If-None-Match", "").split(",")}
+    if "*" in etiquetas or etag in etiquetas:
+        return Response(status_code=304, headers=headers)
+    return Response(content=cuerpo, media_type="application/json", headers=headers)
+
 # --- ENDPOINTS ---
 @app.get("/")
 def root():
@@ -139,19 +418,27 @@ def root():
 
 @app.get("/municipio/{municipio}")
 async def consulta_municipio(
+    request: Request,
     municipio: str,
     n_last: int = Query(3, description="Número de últimos valores a obtener")
 ):
     try:
-        datos = await get_datos_municipio(municipio, n_last=n_last)
+        datos, stale_since = await get_datos_municipio(
+            request.app.state.client, municipio, n_last=n_last, redis=request.app.state.redis
+        )
         if not datos:
             return {"status": "warning", "message": f"No se encontraron series para {municipio}"}
-        return {
+        respuesta = {
             "status": "ok",
             "municipio": municipio,
             "n_series": len(datos),
             "datos": datos
         }
+        if stale_since is not None:
+            respuesta["stale"] = True
+            respuesta["stale_since"] = stale_since
+        cacheable = stale_since is None and bool(tablas_validas(datos))
+        return respuesta_cacheable(request, respuesta, max_age=CACHE_TTL if cacheable else 0)
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
@@ -0,0 +1,315 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def limpiar_estado():
+    """Vacía las cachés de módulo para que cada test empiece desde cero."""
+    for c in (
+        main.cache, main.ultimo_valido, main.etags_ine,
+        main.cache_series_tabla, main.cache_datos_serie, main.inflight,
+    ):
+        c.clear()
+    yield
+
+
+def cliente(handler) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_get_json_async_revalida_con_etag_y_304():
+    peticiones = []
+
+    def handler(request):
+        peticiones.append(request)
+        if request.headers.get("If-None-Match") == '"v1"':
+            return httpx.Response(304, headers={"ETag": '"v1"'})
+        return httpx.Response(200, json=[{"COD": "A"}], headers={"ETag": '"v1"'})
+
+    async def run():
+        async with cliente(handler) as client:
+            primero = await main.get_json_async(client, "https://ine.test/x", main.cache_datos_serie)
+            main.cache_datos_serie.clear()  # simula la caducidad del TTL
+            segundo = await main.get_json_async(client, "https://ine.test/x", main.cache_datos_serie)
+        return primero, segundo
+
+    primero, segundo = asyncio.run(run())
+    assert primero == segundo == [{"COD": "A"}]
+    assert len(peticiones) == 2
+    assert peticiones[1].headers["If-None-Match"] == '"v1"'
+
+
+def handler_ine(fallar_datos: bool):
+    """Simula el INE: una serie de 'Madrid' por tabla; DATOS_SERIE puede devolver 503."""
+    def handler(request):
+        path = request.url.path
+        if "/SERIES_TABLA/" in path:
+            tabla = path.rsplit("/", 1)[-1]
+            return httpx.Response(200, json=[
+                {"COD": f"S{tabla}", "Nombre": f"Madrid. Total {tabla}"},
+                {"COD": f"X{tabla}", "Nombre": f"Humanes de Madrid. Total {tabla}"},
+            ])
+        if fallar_datos:
+            return httpx.Response(503)
+        return httpx.Response(200, json={"Data": [{"Valor": 1}]})
+    return handler
+
+
+def test_fallback_a_ultimo_valido_si_fallan_las_series(monkeypatch):
+    monkeypatch.setattr(main, "_espera_reintento", lambda *a, **k: 0)
+
+    async def run():
+        async with cliente(handler_ine(fallar_datos=False)) as client:
+            bueno, stale = await main.get_datos_municipio(client, "Madrid")
+        assert stale is None and main.tablas_validas(bueno) == bueno
+
+        # Caduca la caché agregada y la de DATOS_SERIE; SERIES_TABLA sigue cacheada
+        main.cache.clear()
+        main.cache_datos_serie.clear()
+        async with cliente(handler_ine(fallar_datos=True)) as client:
+            datos, stale = await main.get_datos_municipio(client, "Madrid")
+        return bueno, datos, stale
+
+    bueno, datos, stale = asyncio.run(run())
+    assert datos == bueno
+    assert stale is not None
+    clave = main.clave_cache("Madrid", 3)
+    assert main.ultimo_valido[clave][1] == bueno
+    assert clave not in main.cache
+
+
+def test_resultado_sin_tablas_validas_no_se_cachea(monkeypatch):
+    monkeypatch.setattr(main, "_espera_reintento", lambda *a, **k: 0)
+
+    async def run():
+        async with cliente(handler_ine(fallar_datos=True)) as client:
+            return await main.get_datos_municipio(client, "Madrid")
+
+    datos, stale = asyncio.run(run())
+    assert stale is None
+    assert main.tablas_validas(datos) == {}
+    assert not main.cache and not main.ultimo_valido
+
+
+def test_tabla_con_404_permanente_no_impide_cachear():
+    rota = main.TABLAS_MUNICIPALES["poblacion_municipio"]
+    base = handler_ine(fallar_datos=False)
+    peticiones = []
+
+    def handler(request):
+        peticiones.append(request.url.path)
+        if request.url.path.endswith(f"/SERIES_TABLA/{rota}"):
+            return httpx.Response(404)
+        return base(request)
+
+    async def run():
+        async with cliente(handler) as client:
+            primero = await main.get_datos_municipio(client, "Madrid")
+            n = len(peticiones)
+            segundo = await main.get_datos_municipio(client, "Madrid")
+        return primero, segundo, n
+
+    (datos, stale), segundo, n = asyncio.run(run())
+    assert stale is None
+    assert "error" in datos["poblacion_municipio"]
+    assert segundo == (datos, None)
+    assert len(peticiones) == n  # la segunda consulta sale de la caché
+    clave = main.clave_cache("Madrid", 3)
+    _, respaldo = main.ultimo_valido[clave]
+    assert set(respaldo) == set(main.TABLAS_MUNICIPALES) - {"poblacion_municipio"}
+
+
+def test_compactar_series_ignora_filas_invalidas():
+    data = [
+        {"COD": "1", "Nombre": None},
+        "no es un dict",
+        {"COD": "2", "Nombre": "Madrid. Censo"},
+        {"COD": "3", "Nombre": "Madrid. Total"},
+    ]
+    series = main.compactar_series(data)
+    assert [s["COD"] for s in series if main.coincide_municipio(s["Nombre"], "Madrid")] == ["3"]
+
+
+
+class RedisFalso:
+    """Sustituto mínimo de redis.asyncio.Redis (get/setex)."""
+
+    def __init__(self, valores=None):
+        self.valores = dict(valores or {})
+
+    async def get(self, clave):
+        return self.valores.get(clave)
+
+    async def setex(self, clave, ttl, valor):
+        self.valores[clave] = valor
+
+
+def test_acierto_en_redis_alimenta_ultimo_valido():
+    clave = main.clave_cache("Madrid", 3)
+    datos = {"poblacion_municipio": {"Madrid. Total": [1]}}
+    redis = RedisFalso({clave: main.orjson.dumps({"ts": 123.0, "datos": datos})})
+
+    def handler(request):
+        raise AssertionError("no debe consultarse el INE")
+
+    async def run():
+        async with cliente(handler) as client:
+            return await main.get_datos_municipio(client, "Madrid", redis=redis)
+
+    assert asyncio.run(run()) == (datos, None)
+    assert main.ultimo_valido[clave] == (123.0, datos)
+
+
+def test_valor_corrupto_en_redis_es_un_fallo_de_cache(monkeypatch):
+    monkeypatch.setattr(main, "_espera_reintento", lambda *a, **k: 0)
+    clave = main.clave_cache("Madrid", 3)
+    redis = RedisFalso({clave: b"{no es json"})
+
+    async def run():
+        async with cliente(handler_ine(fallar_datos=False)) as client:
+            return await main.get_datos_municipio(client, "Madrid", redis=redis)
+
+    datos, stale = asyncio.run(run())
+    assert stale is None and main.tablas_validas(datos) == datos
+    assert main.orjson.loads(redis.valores[clave])["datos"] == datos
+
+
+@pytest.mark.parametrize("nombre", [
+    "Madrid. Total", "Madrid—Población", "Madrid…", "Madrid•total",
+    "Madrid° total", "Madrid€ total", "MADRID (capital)",
+])
+def test_coincide_municipio_trata_cualquier_simbolo_como_separador(nombre):
+    assert main.coincide_municipio(nombre, "Madrid")
+
+
+def test_coincide_municipio_exige_prefijo_exacto():
+    assert not main.coincide_municipio("Humanes de Madrid. Total", "Madrid")
+    assert main.coincide_municipio("Alcalá-Meco, total", "alcala-meco")
+
+
+def test_get_json_async_reintenta_errores_transitorios(monkeypatch):
+    esperas = []
+
+    async def sleep_falso(segundos):
+        esperas.append(segundos)
+
+    monkeypatch.setattr(main.asyncio, "sleep", sleep_falso)
+    respuestas = iter([
+        httpx.Response(503, headers={"Retry-After": "2"}),
+        httpx.Response(200, json=[1]),
+    ])
+
+    async def run():
+        async with cliente(lambda request: next(respuestas)) as client:
+            return await main.get_json_async(client, "https://ine.test/x")
+
+    assert asyncio.run(run()) == [1]
+    assert esperas == [2.0]
+
+
+def test_get_json_async_no_reintenta_si_retry_after_supera_el_limite(monkeypatch):
+    esperas = []
+    peticiones = []
+
+    async def sleep_falso(segundos):
+        esperas.append(segundos)
+
+    def handler(request):
+        peticiones.append(request)
+        return httpx.Response(429, headers={"Retry-After": "3600"})
+
+    monkeypatch.setattr(main.asyncio, "sleep", sleep_falso)
+
+    async def run():
+        async with cliente(handler) as client:
+            await main.get_json_async(client, "https://ine.test/x")
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(run())
+    assert esperas == []
+    assert len(peticiones) == 1
+
+
+def test_consultas_simultaneas_comparten_una_sola_descarga():
+    peticiones = []
+    base = handler_ine(fallar_datos=False)
+
+    async def handler(request):
+        peticiones.append(request.url.path)
+        await asyncio.sleep(0.01)  # mantiene la primera consulta en curso
+        return base(request)
+
+    async def run():
+        async with cliente(handler) as client:
+            return await asyncio.gather(
+                main.get_datos_municipio(client, "Madrid"),
+                main.get_datos_municipio(client, "madrid"),
+            )
+
+    primero, segundo = asyncio.run(run())
+    assert primero == segundo
+    assert len(peticiones) == 2 * len(main.TABLAS_MUNICIPALES)  # SERIES_TABLA + DATOS_SERIE
+    assert not main.inflight
+
+
+@pytest.fixture
+def api():
+    """TestClient sin lifespan: cada test fija su propio cliente INE simulado."""
+    from fastapi.testclient import TestClient
+
+    estado = main.app.state
+    estado.redis = None
+
+    def con_ine(handler):
+        estado.client = cliente(handler)
+        return TestClient(main.app)
+
+    yield con_ine
+    del estado.client, estado.redis
+
+
+def test_endpoint_envia_etag_y_max_age(api):
+    resp = api(handler_ine(fallar_datos=False)).get("/municipio/Madrid")
+    assert resp.status_code == 200
+    assert resp.json()["status"] == "ok"
+    assert resp.headers["Cache-Control"] == f"public, max-age={main.CACHE_TTL}"
+    etag = resp.headers["ETag"]
+    assert etag == f'"{main.hashlib.blake2b(resp.content).hexdigest()[:16]}"'
+
+
+@pytest.mark.parametrize("if_none_match", ["{etag}", "W/{etag}", '"otro", {etag}', "*"])
+def test_endpoint_responde_304_si_coincide_if_none_match(api, if_none_match):
+    client = api(handler_ine(fallar_datos=False))
+    etag = client.get("/municipio/Madrid").headers["ETag"]
+    resp = client.get(
+        "/municipio/Madrid", headers={"If-None-Match": if_none_match.format(etag=etag)}
+    )
+    assert resp.status_code == 304
+    assert resp.headers["ETag"] == etag
+    assert resp.content == b""
+
+
+def test_endpoint_no_304_si_el_etag_no_coincide(api):
+    resp = api(handler_ine(fallar_datos=False)).get(
+        "/municipio/Madrid", headers={"If-None-Match": '"otro"'}
+    )
+    assert resp.status_code == 200
+
+
+def test_endpoint_stale_o_sin_tablas_validas_va_sin_cache(api, monkeypatch):
+    monkeypatch.setattr(main, "_espera_reintento", lambda *a, **k: 0)
+
+    resp = api(handler_ine(fallar_datos=True)).get("/municipio/Madrid")
+    assert resp.json()["status"] == "ok" and "stale" not in resp.json()
+    assert resp.headers["Cache-Control"] == "no-cache"
+
+    api(handler_ine(fallar_datos=False)).get("/municipio/Madrid")
+    main.cache.clear()
+    main.cache_datos_serie.clear()
+    resp = api(handler_ine(fallar_datos=True)).get("/municipio/Madrid")
+    assert resp.json()["stale"] is True
+    assert resp.headers["Cache-Control"] == "no-cache"